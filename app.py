@@ -1,19 +1,29 @@
 import os
-import base64
-import pickle
+import io
+import asyncio
+import hashlib
+import itertools
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.generator import BytesGenerator
 from email.message import EmailMessage
-import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
 from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
+from google_auth_oauthlib.flow import Flow
+from oauthlib.oauth2.rfc6749.errors import OAuth2Error
 from googleapiclient.discovery import build
-from PyPDF2 import PdfReader
+from googleapiclient.http import MediaIoBaseUpload
 from google.oauth2 import service_account
+from google.oauth2.credentials import Credentials
 from google.cloud import firestore
 import json
 from datetime import datetime
-from openai import OpenAI  # <-- NEW: OpenAI import
+# pandas, openai, pypdfium2, langdetect and google.cloud.storage are imported where they are used,
+# so the auth screen does not pay for them on a cold start
 
 # ================================
 # SETUP & CONFIGURATION
@@ -21,82 +31,219 @@ from openai import OpenAI  # <-- NEW: OpenAI import
 load_dotenv()
 # --- NEW: Using OpenAI API Key ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
 
 CSV_FILE = "Assistenzarzt_Jobs_CH__Combined_Final.csv"
+# Columns the Job Finder reads, with their parse dtypes; everything else in the CSV is skipped.
+# Hospitals and locations repeat across postings, so they are parsed as categories.
+JOB_COLUMN_DTYPES = {
+    "Job Title": "string", "Hospital/Institution": "category", "Location": "category",
+    "Application Contact Email": "string", "Application URL": "string", "Job Description (short)": "string",
+}
+# CSV headers mapped to the names the job details and prompts use
+JOB_COLUMN_RENAMES = {"Job Title": "job_title", "Hospital/Institution": "hospital_name", "Location": "canton"}
 SCOPES = ["https://www.googleapis.com/auth/gmail.send"]
+REDIRECT_URI = os.getenv("REDIRECT_URI", "http://localhost:8501")
+OAUTH_STATE_TTL_SECONDS = 10 * 60
 DB_COLLECTION = "job_applications_v2"
 DB_DOCUMENT_ID = "user_profile"
+CV_CACHE_COLLECTION = "cv_cache"
+GCS_BUCKET = os.getenv("GCS_BUCKET")
+DASHBOARD_PAGE_SIZE = 25
+PREGENERATE_COUNT = 5
+SEND_POLL_INTERVAL = "2s"
+DRAFT_MODEL = "gpt-4o-mini"
+POLISH_MODEL = "gpt-4o"
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+GERMAN_CHARS = frozenset("äöüÄÖÜß")
+MAX_ATTACHMENTS_BYTES = 25 * 1024 * 1024  # Gmail's limit for the attachments of one message
+EMAIL_SYSTEM_MESSAGE = "You are a professional medical job applicant assistant, writing in German."
 
 # ================================
 # FIREBASE & GMAIL AUTHENTICATION
 # ================================
-@st.cache_resource
+def get_service_account_credentials():
+    firebase_creds_json = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
+    if not firebase_creds_json:
+        raise RuntimeError("Firebase service account JSON not found.")
+    creds_dict = json.loads(firebase_creds_json)
+    return service_account.Credentials.from_service_account_info(creds_dict)
+
+# The cached clients raise on failure instead of returning None, so a failure is never cached
+# and the next rerun retries; the uncached wrappers turn the error into st.error
+@st.cache_resource(show_spinner=False)
+def _get_firestore_client():
+    return firestore.Client(credentials=get_service_account_credentials())
+
 def get_firestore_db():
     try:
-        firebase_creds_json = os.getenv("FIREBASE_SERVICE_ACCOUNT_JSON")
-        if not firebase_creds_json:
-            st.error("Firebase service account JSON not found.")
-            return None
-        creds_dict = json.loads(firebase_creds_json)
-        creds = service_account.Credentials.from_service_account_info(creds_dict)
-        return firestore.Client(credentials=creds)
+        return _get_firestore_client()
     except Exception as e:
         st.error(f"Failed to connect to Firebase: {e}")
         return None
 
-def gmail_authenticate():
+@st.cache_resource(show_spinner=False)
+def _get_storage_bucket():
+    from google.cloud import storage
+    creds = get_service_account_credentials()
+    return storage.Client(credentials=creds, project=creds.project_id).bucket(GCS_BUCKET)
+
+def get_storage_bucket():
+    """Returns the attachments bucket, or None when GCS_BUCKET is not configured or unreachable."""
+    if not GCS_BUCKET:
+        return None
+    try:
+        return _get_storage_bucket()
+    except Exception as e:
+        st.error(f"Failed to connect to Cloud Storage: {e}")
+        return None
+
+@st.cache_resource
+def get_google_client_config():
+    client_secret_json = os.getenv("GOOGLE_CLIENT_SECRET_JSON")
+    return json.loads(client_secret_json) if client_secret_json else None
+
+def get_gmail_auth_flow():
+    client_config = get_google_client_config()
+    if not client_config:
+        st.error("Google client secret JSON not found.")
+        return None
+    # No PKCE verifier: the redirect lands in a fresh Streamlit session that could not recall it
+    return Flow.from_client_config(client_config, scopes=SCOPES, redirect_uri=REDIRECT_URI, autogenerate_code_verifier=False)
+
+@st.cache_resource
+def _issued_oauth_states():
+    # The OAuth redirect lands in a new session, so the states handed out are kept process-wide,
+    # mapped to when they were issued so abandoned sign-ins expire
+    return {}, threading.Lock()
+
+def _prune_oauth_states(states):
+    cutoff = time.monotonic() - OAUTH_STATE_TTL_SECONDS
+    for state in [s for s, issued_at in states.items() if issued_at < cutoff]:
+        del states[state]
+
+def _remember_oauth_state(state):
+    states, lock = _issued_oauth_states()
+    with lock:
+        _prune_oauth_states(states)
+        states[state] = time.monotonic()
+
+def _consume_oauth_state(state):
+    """Returns True if the state was issued recently and not used yet; each state is accepted once."""
+    states, lock = _issued_oauth_states()
+    with lock:
+        _prune_oauth_states(states)
+        return states.pop(state, None) is not None
+
+def get_gmail_auth_url():
+    """Returns the Google sign-in URL and remembers its state for the redirect check."""
+    flow = get_gmail_auth_flow()
+    if not flow:
+        return None
+    auth_url, state = flow.authorization_url(access_type="offline", prompt="consent")
+    _remember_oauth_state(state)
+    return auth_url
+
+def gmail_authenticate(auth_code=None, state=None):
+    """Returns a Gmail service from the stored token or the OAuth redirect code, or None if the user must authorize.
+
+    A redirect code is only exchanged if its state was issued by get_gmail_auth_url.
+    """
     db = get_firestore_db()
-    creds = None
-    if db:
-        doc_ref = db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID)
-        doc = doc_ref.get()
-        if doc.exists and 'gmail_token' in doc.to_dict():
-            creds = pickle.loads(base64.b64decode(doc.to_dict()['gmail_token']))
+    # Shares the cached profile read with the upload step that follows
+    token_json = get_user_data(db).get('gmail_token_json')
+    creds = _deserialize_creds(token_json) if token_json else None
 
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
-        else:
-            client_secret_json = os.getenv("GOOGLE_CLIENT_SECRET_JSON")
-            if not client_secret_json:
-                st.error("Google client secret JSON not found.")
+        elif auth_code:
+            if not _consume_oauth_state(state):
+                st.error("This sign-in has expired or was not started from this app. Please sign in with Google again.")
+                return None
+            flow = get_gmail_auth_flow()
+            if not flow:
+                return None
+            try:
+                flow.fetch_token(code=auth_code)
+            except OAuth2Error as e:
+                # E.g. a code that was already used, after Back/refresh or a double submit
+                st.error(f"Google sign-in failed: {e.description or e.error}. Please sign in again.")
                 return None
-            client_config = json.loads(client_secret_json)
-            flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
-            creds = flow.run_local_server(port=0)
+            creds = flow.credentials
+        else:
+            return None
         
-        if db:
-            token_b64 = base64.b64encode(pickle.dumps(creds)).decode('utf-8')
-            doc_ref.set({'gmail_token': token_b64}, merge=True)
-            
-    return build("gmail", "v1", credentials=creds)
+        token_json = creds.to_json()
+        # Drops the pickled token older versions stored; it is never unpickled
+        update_user_data(db, {'gmail_token_json': token_json, 'gmail_token': firestore.DELETE_FIELD})
+
+    # Built per session and kept in session_state: httplib2 is not thread-safe, so a process-wide
+    # service would let two sessions' send executors share one connection
+    return build_gmail_service(creds)
+
+def _deserialize_creds(token_json):
+    return Credentials.from_authorized_user_info(json.loads(token_json), SCOPES)
+
+def build_gmail_service(creds):
+    # Use the discovery document bundled with googleapiclient instead of fetching it over HTTP
+    return build("gmail", "v1", credentials=creds, static_discovery=True, cache_discovery=False)
 
 # ================================
 # API & HELPER FUNCTIONS
 # ================================
-def call_openai_api(prompt, system_message="You are a helpful assistant."):
-    """Generic function to call the OpenAI API."""
+@st.cache_resource
+def get_openai_client():
+    # Built once per process so its HTTP connection pool survives script reruns
+    from openai import OpenAI
+    return OpenAI(api_key=OPENAI_API_KEY)
+
+def _iter_stream_text(response):
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def call_openai_api(prompt, system_message="You are a helpful assistant.", response_format=None, stream=False, model=DRAFT_MODEL):
+    """Generic function to call the OpenAI API. With stream=True, returns a generator of text chunks."""
     try:
         if not OPENAI_API_KEY:
             st.error("OpenAI API key is not configured. Please add it to your environment variables.")
             return None
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        extra_args = {"response_format": response_format} if response_format else {}
+        response = get_openai_client().chat.completions.create(
+            model=model,
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": prompt},
             ],
             temperature=0.5,
+            stream=stream,
+            **extra_args,
         )
+        if stream:
+            return _iter_stream_text(response)
         return response.choices[0].message.content.strip()
     except Exception as e:
         st.error(f"Error calling OpenAI API: {e}")
         return None
 
-def generate_personalized_email(job_title, hospital_name, canton, job_description, cv_content):
-    """Generates an email subject and body using OpenAI."""
-    prompt = f"""
+async def acall_openai_api(aclient, prompt, system_message="You are a helpful assistant.", model=DRAFT_MODEL):
+    """Async counterpart of call_openai_api so independent requests can run concurrently."""
+    try:
+        response = await aclient.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.5,
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        st.error(f"Error calling OpenAI API: {e}")
+        return None
+
+def build_email_prompt(job_title, hospital_name, canton, job_description, cv_content):
+    return f"""
 Act as a professional medical career advisor in Switzerland.
 Your task is to create a compelling application email in German.
 
@@ -119,7 +266,9 @@ Your task is to create a compelling application email in German.
 3.  **Output Format:** Your final output MUST contain the subject and body separated by '|||'.
     Example: Betreff: Bewerbung als Assistenzarzt|||Sehr geehrte Damen und Herren,...
 """
-    response = call_openai_api(prompt, "You are a professional medical job applicant assistant, writing in German.")
+
+def parse_email_response(response, job_title):
+    """Splits a 'subject|||body' model response into the email content dict."""
     if response and '|||' in response:
         parts = response.split('|||', 1)
         subject = parts[0].replace('Betreff:', '').replace('Subject:', '').strip()
@@ -128,36 +277,170 @@ Your task is to create a compelling application email in German.
     
     return {'subject': f"Bewerbung als {job_title}", 'body': response or "Could not generate email body."}
 
+class _EmailGenerationFailed(Exception):
+    pass
+
+@st.cache_data(ttl=86400, show_spinner=False, max_entries=500)
+def _generate_personalized_email_cached(job_title, hospital_name, canton, job_description, cv_content):
+    prompt = build_email_prompt(job_title, hospital_name, canton, job_description, cv_content)
+    response = call_openai_api(prompt, EMAIL_SYSTEM_MESSAGE)
+    if response is None:
+        raise _EmailGenerationFailed()  # Raising keeps the failure out of the cache
+    return parse_email_response(response, job_title)
+
+def generate_personalized_email(job_title, hospital_name, canton, job_description, cv_content):
+    """Generates an email subject and body using OpenAI; identical inputs are served from cache for a day."""
+    try:
+        return _generate_personalized_email_cached(job_title, hospital_name, canton, job_description, cv_content)
+    except _EmailGenerationFailed:
+        return parse_email_response(None, job_title)
+
+async def _agenerate_personalized_emails(jobs, cv_content):
+    # A fresh client per event loop: asyncio.run() closes its loop, and httpx connections are bound to it
+    from openai import AsyncOpenAI
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY) as aclient:
+        responses = await asyncio.gather(*[
+            acall_openai_api(aclient, build_email_prompt(
+                job['job_title'], job['hospital_name'], job['canton'], job['job_description'], cv_content
+            ), EMAIL_SYSTEM_MESSAGE)
+            for job in jobs
+        ])
+    return [parse_email_response(response, job['job_title']) if response else None for job, response in zip(jobs, responses)]
+
+def generate_personalized_emails(jobs, cv_content):
+    """Generates one email per job with concurrent OpenAI calls. Returns one dict (or None) per job."""
+    if not OPENAI_API_KEY:
+        st.error("OpenAI API key is not configured. Please add it to your environment variables.")
+        return [None] * len(jobs)
+    return asyncio.run(_agenerate_personalized_emails(jobs, cv_content))
+
+def generate_personalized_emails_batch(jobs, cv_content):
+    """Generates drafts for several jobs with a single OpenAI call. Returns one dict (or None) per job."""
+    job_blocks = "\n".join(
+        f"[Job {n}]\n- Position: {job['job_title']}\n- Hospital: {job['hospital_name']}\n"
+        f"- Canton: {job['canton']}\n- Job Description: {job['job_description']}\n"
+        for n, job in enumerate(jobs, start=1)
+    )
+    prompt = f"""
+Act as a professional medical career advisor in Switzerland.
+Your task is to create one compelling application email in German for EACH of the jobs below.
+
+**Applicant's Profile (from CV):**
+---
+{cv_content}
+---
+**Jobs:**
+---
+{job_blocks}
+---
+
+**Instructions:**
+1.  For every job, write a concise, professional German subject line and a polite, personalized email body
+    connecting the applicant's CV to that job description.
+2.  **Output Format:** Return a JSON object of the form
+    {{"drafts": [{{"job": 1, "subject": "...", "body": "..."}}, ...]}} with exactly one entry per job.
+"""
+    response = call_openai_api(prompt, EMAIL_SYSTEM_MESSAGE, response_format={"type": "json_object"})
+    drafts = [None] * len(jobs)
+    if not response:
+        return drafts
+    try:
+        for draft in json.loads(response).get("drafts", []):
+            n = int(draft.get("job", 0))
+            if 1 <= n <= len(jobs) and draft.get("subject") and draft.get("body"):
+                drafts[n - 1] = {'subject': draft["subject"].strip(), 'body': draft["body"].strip()}
+    except (ValueError, TypeError, AttributeError) as e:
+        st.error(f"Could not parse the generated drafts: {e}")
+    return drafts
+
+def polish_email_body(body):
+    """Rewrites a drafted email body with the stronger model."""
+    prompt = f"Polish the following German job application email. Improve tone, flow and grammar, keep all facts, and return only the revised email body.\n\n**Email:**\n---\n{body}\n---"
+    return call_openai_api(prompt, EMAIL_SYSTEM_MESSAGE, model=POLISH_MODEL)
+
+@st.cache_data(show_spinner=False)
+def cv_looks_german(text):
+    # Cached so radio toggles and button clicks on the upload step do not rerun langdetect
+    from langdetect import DetectorFactory, LangDetectException, detect
+    DetectorFactory.seed = 0  # langdetect is randomized; keep the answer stable across reruns
+    try:
+        return detect(text[:4000]) == "de"
+    except LangDetectException:
+        # No usable features (e.g. almost no letters): fall back to the character check,
+        # where set.isdisjoint stops at the first German-only character
+        return not GERMAN_CHARS.isdisjoint(text[:2000])
+
 def translate_cv_text(text):
     prompt = f"Please translate the following CV text from English to professional, high-quality German suitable for a medical job application in Switzerland.\n\n**Text to Translate:**\n---\n{text}\n---"
     system_message = "You are an expert translator specializing in medical and professional documents."
     return call_openai_api(prompt, system_message)
 
+def build_email_message(to_email, subject, body, attachments):
+    message = EmailMessage()
+    message.set_content(body)
+    message["To"] = to_email
+    message["Subject"] = subject
+    message["From"] = "me"
+    for attachment in attachments:
+        content = load_attachment_bytes(attachment)
+        message.add_attachment(content, maintype="application", subtype="octet-stream", filename=attachment["name"])
+    return message
+
+def send_gmail_message(service, message):
+    # Runs on the background send executor, so it must not call into st.*
+    # Upload the MIME bytes as media rather than base64 inside the JSON body.
+    # Serializing straight into the buffer avoids the extra full-size copy as_bytes() makes.
+    raw_message = io.BytesIO()
+    BytesGenerator(raw_message, policy=message.policy).flatten(message)
+    size = raw_message.tell()
+    raw_message.seek(0)
+    media = MediaIoBaseUpload(
+        raw_message, mimetype="message/rfc822", resumable=size > RESUMABLE_UPLOAD_THRESHOLD,
+    )
+    # No num_retries: messages.send is not idempotent, and a retry after a timeout on a message
+    # Gmail already accepted would deliver the same application again
+    service.users().messages().send(userId="me", body={}, media_body=media).execute()
+
 def send_email_logic(service, to_email, subject, body, attachments):
+    """Builds the email and queues it on the session's send executor. Returns the Future, or None on error."""
     try:
-        message = EmailMessage()
-        message.set_content(body)
-        message["To"] = to_email
-        message["Subject"] = subject
-        message["From"] = "me"
-        for uploaded_file in attachments:
-            uploaded_file.seek(0)
-            content = uploaded_file.read()
-            message.add_attachment(content, maintype="application", subtype="octet-stream", filename=uploaded_file.name)
-        encoded_message = base64.b64encode(message.as_bytes()).decode()
-        create_message = {"raw": encoded_message}
-        service.users().messages().send(userId="me", body=create_message).execute()
-        st.success(f"✅ Application successfully sent to {to_email}!")
-        return True
+        message = build_email_message(to_email, subject, body, attachments)
     except Exception as e:
-        st.error(f"An error occurred while sending the email: {e}")
-        return False
+        st.error(f"An error occurred while preparing the email: {e}")
+        return None
+    return st.session_state.send_executor.submit(send_gmail_message, service, message)
+
+def attachment_from_upload(uploaded_file):
+    return {"name": uploaded_file.name, "bytes": uploaded_file.getvalue(), "size": uploaded_file.size}
 
-def extract_text_from_pdf(file):
+def load_attachment_bytes(attachment):
+    """Returns the attachment content, downloading it from Cloud Storage if it was persisted there."""
+    if "gcs_path" in attachment:
+        bucket = get_storage_bucket()
+        if bucket is None:
+            raise RuntimeError(f"Cloud Storage is unavailable, so '{attachment['name']}' cannot be attached.")
+        return bucket.blob(attachment["gcs_path"]).download_as_bytes()
+    return attachment["bytes"]
+
+@st.cache_data(show_spinner=False, hash_funcs={bytes: lambda b: hashlib.sha256(b).digest()})
+def extract_text_from_pdf(file_bytes):
     try:
-        reader = PdfReader(file)
-        text = "".join(page.extract_text() for page in reader.pages if page.extract_text())
-        return text
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(file_bytes)
+        buf = io.StringIO()
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                page_text = textpage.get_text_range()
+                # Release each page's native handles now instead of holding them until the document closes
+                textpage.close()
+                page.close()
+                if page_text:
+                    buf.write(page_text)
+                    buf.write("\n")
+        finally:
+            pdf.close()
+        return buf.getvalue()
     except Exception as e:
         st.error(f"Error reading PDF file: {e}")
         return None
@@ -165,40 +448,244 @@ def extract_text_from_pdf(file):
 # ================================
 # DATABASE FUNCTIONS
 # ================================
-def get_user_data(db):
+@st.cache_data(ttl="30s", show_spinner=False)
+def _get_user_data_cached(profile_id):
+    db = get_firestore_db()
     if not db: return {}
-    doc = db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).get()
+    doc = db.collection(DB_COLLECTION).document(profile_id).get()
     return doc.to_dict() if doc.exists else {}
 
+def get_user_data(db):
+    if not db: return {}
+    return _get_user_data_cached(DB_DOCUMENT_ID)
+
 def update_user_data(db, data_to_update):
     if not db: return
     db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).set(data_to_update, merge=True)
+    _get_user_data_cached.clear()
+
+def load_user_data(db):
+    """Returns the session's copy of the user document, reading Firestore only once per session."""
+    if st.session_state.user_data is None:
+        st.session_state.user_data = get_user_data(db)
+    return st.session_state.user_data
+
+def apply_user_update(db, patch):
+    """Writes plain field values to the user document and mirrors them into the session copy."""
+    update_user_data(db, patch)
+    if st.session_state.user_data is not None:
+        st.session_state.user_data.update(patch)
+
+def bump_local_stat(stat_field, delta):
+    # Mirrors a stats Increment() into the session copy of the user document
+    if st.session_state.user_data is not None:
+        stats = st.session_state.user_data.setdefault("stats", {})
+        stats[stat_field] = stats.get(stat_field, 0) + delta
 
 def save_sent_email(db, email_data):
+    if not db: return None
+    _, email_ref = db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).collection("sent_emails").add(email_data)
+    fetch_sent_emails_page.clear()
+    return email_ref
+
+@st.cache_data(ttl="60s", show_spinner=False)
+def fetch_sent_emails_page(profile_id, start_after_sent_at=None):
+    """Returns one dashboard page of (id, fields) pairs, newest first, without the email bodies."""
+    db = get_firestore_db()
+    if not db: return []
+    query = (
+        db.collection(DB_COLLECTION).document(profile_id).collection("sent_emails")
+        .select(["recipient", "subject", "sent_at", "status"])
+        .order_by("sent_at", direction=firestore.Query.DESCENDING)
+    )
+    if start_after_sent_at is not None:
+        query = query.start_after({"sent_at": start_after_sent_at})
+    return [(doc.id, doc.to_dict()) for doc in query.limit(DASHBOARD_PAGE_SIZE).stream()]
+
+def get_sent_email_body(db, email_id):
+    if not db: return ""
+    doc = db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).collection("sent_emails").document(email_id).get()
+    return doc.to_dict().get('body', '') if doc.exists else ""
+
+def get_cached_translation(db, cv_hash):
+    if not db: return None
+    doc = db.collection(CV_CACHE_COLLECTION).document(cv_hash).get()
+    return doc.to_dict().get("cv_text") if doc.exists else None
+
+def save_cached_translation(db, cv_hash, cv_text):
     if not db: return
-    db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).collection("sent_emails").add(email_data)
+    db.collection(CV_CACHE_COLLECTION).document(cv_hash).set({"cv_text": cv_text})
+
+def save_attachments(db, uploaded_files):
+    """Uploads the files to Cloud Storage and records their metadata on the user document.
+
+    Without a configured bucket the files are kept in the session only.
+    """
+    bucket = get_storage_bucket()
+    if not db or not bucket:
+        return [attachment_from_upload(f) for f in uploaded_files]
+
+    def upload(uploaded_file):
+        # Stream from the in-memory upload instead of copying it into a bytes object first
+        gcs_path = f"users/{DB_DOCUMENT_ID}/{uploaded_file.name}"
+        bucket.blob(gcs_path).upload_from_file(
+            uploaded_file, rewind=True, size=uploaded_file.size, content_type=uploaded_file.type
+        )
+        return {"name": uploaded_file.name, "gcs_path": gcs_path, "size": uploaded_file.size}
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        attachments = list(executor.map(upload, uploaded_files))
+    apply_user_update(db, {"attachments": attachments})
+    return list(attachments)  # The session user_data now holds the original list
+
+def get_applied_job_ids(db):
+    """Returns the applied job IDs as ints; Firestore stores them as string document IDs."""
+    if not db: return set()
+    applied_ref = db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).collection("applied_jobs")
+    return {int(doc.id) for doc in applied_ref.select([]).stream()}
+
+def mark_job_applied(db, job_id, stat_field, sent_email=None):
+    """Records the job in the applied_jobs subcollection and bumps the given stats counter.
+
+    A sent_email record is written in the same batch; its document reference is returned.
+    """
+    if not db: return None
+    user_ref = db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID)
+    batch = db.batch()
+    email_ref = None
+    if sent_email is not None:
+        email_ref = user_ref.collection("sent_emails").document()
+        batch.set(email_ref, sent_email)
+    batch.set(user_ref.collection("applied_jobs").document(str(job_id)), {"ts": firestore.SERVER_TIMESTAMP})
+    batch.set(user_ref, {"stats": {stat_field: firestore.Increment(1)}}, merge=True)
+    batch.commit()
+    _get_user_data_cached.clear()
+    bump_local_stat(stat_field, 1)
+    if email_ref is not None:
+        fetch_sent_emails_page.clear()
+    return email_ref
+
+def unmark_job_applied(db, job_id, stat_field, email_ref=None, email_update=None):
+    """Reverts mark_job_applied, e.g. when a queued send fails. An email_update is applied in the same batch.
+
+    Only touches Firestore, so it is safe to call from the send executor's thread.
+    """
+    if not db: return
+    user_ref = db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID)
+    batch = db.batch()
+    if email_ref is not None:
+        batch.update(email_ref, email_update)
+    batch.delete(user_ref.collection("applied_jobs").document(str(job_id)))
+    batch.set(user_ref, {"stats": {stat_field: firestore.Increment(-1)}}, merge=True)
+    batch.commit()
+
+def record_send_outcome(db, future, email_ref, job_id=None):
+    """Writes the final status of a background send to Firestore as soon as it finishes.
+
+    The write runs as a done-callback on the send executor's thread, so it happens even if the
+    session is gone by then. Returns a Future that resolves to (send_error, record_error) once written.
+    """
+    recorded = Future()
+
+    def on_done(send_future):
+        error = send_future.exception()
+        record_error = None
+        try:
+            if error is None:
+                if email_ref: email_ref.update({"status": "sent"})
+            else:
+                failed_update = {"status": "failed", "error": str(error)}
+                if job_id is not None:
+                    # Put the job back in the queue so it can be retried
+                    unmark_job_applied(db, job_id, "sent_count", email_ref, failed_update)
+                elif email_ref:
+                    email_ref.update(failed_update)
+        except Exception as e:
+            # Exceptions raised in a done-callback are only logged, so hand it to the poll instead
+            record_error = e
+        recorded.set_result((error, record_error))
+
+    future.add_done_callback(on_done)
+    return recorded
+
+# ================================
+# JOBS CSV
+# ================================
+@st.cache_data(ttl="1h", show_spinner=False)
+def load_jobs_df(path, mtime=None):
+    """Loads the jobs CSV once per process; reruns get the cached DataFrame.
+
+    The used columns are mirrored to a Parquet file next to the CSV and read from there
+    until the CSV is modified again. Passing the CSV's mtime makes an edit a cache miss right away.
+    """
+    import pandas as pd
+    # The mirror's name carries the column schema, so changing the columns or dtypes rebuilds it
+    schema = json.dumps([JOB_COLUMN_DTYPES, JOB_COLUMN_RENAMES], sort_keys=True).encode()
+    schema_tag = hashlib.blake2b(schema, digest_size=4).hexdigest()
+    parquet_path = f"{os.path.splitext(path)[0]}.{schema_tag}.parquet"
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(path):
+        df = pd.read_parquet(parquet_path, engine="pyarrow")
+    else:
+        df = pd.read_csv(path, usecols=lambda col: col in JOB_COLUMN_DTYPES, dtype=JOB_COLUMN_DTYPES)
+        df = df.rename(columns=JOB_COLUMN_RENAMES)
+        # Written to a temp file and renamed into place, so a reader never sees a half-written mirror
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(parquet_path) + ".", dir=os.path.dirname(parquet_path) or ".")
+            with os.fdopen(fd, "wb") as tmp_file:
+                df.to_parquet(tmp_file, engine="pyarrow", index=False)
+            os.replace(tmp_path, parquet_path)
+        except OSError:
+            # Read-only deployments just keep parsing the CSV
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    df["_contact_email"] = df["Application Contact Email"].str.split(",", n=1).str[0].str.strip()
+    df["_email_valid"] = df["_contact_email"].str.contains("@", na=False)
+    return df
 
 # ================================
 # UI PAGE FUNCTIONS
 # ================================
+def escape_markdown(text):
+    return re.sub(r"([\\`*_{}\[\]()#+\-.!|<>~$])", r"\\\1", str(text))
+
+@st.fragment
 def render_dashboard(db):
     st.header("📊 Dashboard: Sent Applications")
-    emails_ref = db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).collection("sent_emails").order_by("sent_at", direction=firestore.Query.DESCENDING).stream()
-    
-    emails = list(emails_ref)
+    emails = []
+    has_more = True
+    start_after_sent_at = None
+    for _ in range(st.session_state.dashboard_pages):
+        page = fetch_sent_emails_page(DB_DOCUMENT_ID, start_after_sent_at)
+        emails.extend(page)
+        has_more = len(page) == DASHBOARD_PAGE_SIZE
+        if not has_more:
+            break
+        start_after_sent_at = page[-1][1]['sent_at']
+
     if not emails:
         st.info("You haven't sent any emails yet. Head over to the 'Job Finder' to get started!")
         return
 
-    for email in emails:
-        data = email.to_dict()
+    for email_id, data in emails:
         sent_time = data['sent_at'].strftime("%d %b %Y, %H:%M")
-        with st.expander(f"To: {data['recipient']} | Subject: {data['subject']} | Sent: {sent_time}"):
-            st.write(f"**To:** {data['recipient']}")
-            st.write(f"**Subject:** {data['subject']}")
-            st.write(f"**Sent At:** {sent_time}")
-            st.markdown("---")
-            st.text_area("Email Body", value=data['body'], height=300, disabled=True, key=f"body_{email.id}")
+        status = data.get('status', 'sent')
+        status_label = "" if status == "sent" else f" | {status.upper()}"
+        recipient, subject = escape_markdown(data['recipient']), escape_markdown(data['subject'])
+        with st.expander(f"To: {recipient} | Subject: {subject} | Sent: {sent_time}{status_label}"):
+            body = st.session_state.dashboard_bodies.get(email_id)
+            if body is None and st.button("Load email body", key=f"load_body_{email_id}"):
+                body = get_sent_email_body(db, email_id)
+                st.session_state.dashboard_bodies[email_id] = body
+            # One markdown element for the header and a plain code block for the body, instead of write/text_area widgets
+            st.markdown(f"**To:** {recipient}\n\n**Subject:** {subject}\n\n**Sent At:** {sent_time}\n\n---")
+            if body is not None:
+                # Not markdown: the body is generated or user-edited text and may contain ``` or other markup
+                st.code(body, language=None)
+
+    if has_more and st.button("Load more"):
+        st.session_state.dashboard_pages += 1
+        st.rerun(scope="fragment")
 
 def render_manual_job_page(db):
     st.header("✍️ Add a Job Manually")
@@ -225,41 +712,73 @@ def render_manual_job_page(db):
     elif submitted:
         st.warning("Please fill in at least the Job Title, Hospital, and Email.")
 
-    if 'manual_email_content' in st.session_state and st.session_state.manual_email_content:
+    if st.session_state.manual_email_content:
         render_application_form(db, is_manual=True)
 
-def render_job_finder(db):
+def job_details_from_row(job_id, row_data):
+    import pandas as pd
+
+    def text(column, default=""):
+        # Blank cells come back as pd.NA/NaN, which Firestore cannot store and prompts would show as "<NA>"
+        value = row_data.get(column, default)
+        return default if pd.isna(value) else str(value)
+
+    return {
+        "job_id": job_id, "job_title": text("job_title", "N/A"),
+        "hospital_name": text("hospital_name"), "canton": text("canton"),
+        "contact_email": text("_contact_email"),
+        "application_url": text("Application URL"),
+        "job_description": text("Job Description (short)")
+    }
+
+def draft_cache_key(job_id):
+    # Drafts depend on the CV too, so a different CV in the same session must not reuse them
+    cv_hash = hashlib.blake2b(st.session_state.cv_content.encode(), digest_size=8).hexdigest()
+    return (job_id, cv_hash)
+
+def render_job_finder(db, user_data):
     st.header("🔍 Job Finder")
-    try:
-        jobs_df = pd.read_csv(CSV_FILE)
-        user_data = get_user_data(db)
-        applied_jobs = set(user_data.get("applied_jobs", []))
-    except FileNotFoundError:
-        st.error(f"Error: '{CSV_FILE}' not found.")
-        st.stop()
-    
-    next_job = None
-    for idx, row in jobs_df.iterrows():
-        if str(idx) not in applied_jobs and isinstance(row.get("Application Contact Email"), str) and "@" in row.get("Application Contact Email", ""):
-            next_job = (idx, row)
-            break
-            
-    if next_job is None:
+    if st.session_state.applied_job_ids is None:
+        # Legacy profiles kept applied jobs as an array on the user document
+        st.session_state.applied_job_ids = get_applied_job_ids(db) | {int(job_id) for job_id in user_data.get("applied_jobs", [])}
+    applied_jobs = st.session_state.applied_job_ids
+
+    # While the shown job is still open (e.g. "Prepare Application" reruns), the CSV is not touched at all
+    jobs_df = None
+    current_job_id = st.session_state.current_job_id
+    if current_job_id is None or current_job_id in applied_jobs or st.session_state.eligible_job_ids is None:
+        try:
+            csv_mtime = os.path.getmtime(CSV_FILE)
+            jobs_df = load_jobs_df(CSV_FILE, csv_mtime)
+        except FileNotFoundError:
+            st.error(f"Error: '{CSV_FILE}' not found.")
+            st.stop()
+
+        # The eligible IDs are computed once per session (or CSV change); skips and sends only advance a cursor
+        if st.session_state.eligible_job_ids is None or st.session_state.eligible_csv_mtime != csv_mtime:
+            candidates = jobs_df.index[jobs_df["_email_valid"] & ~jobs_df.index.isin(applied_jobs)]
+            st.session_state.eligible_job_ids = [int(i) for i in candidates]
+            st.session_state.eligible_csv_mtime = csv_mtime
+            st.session_state.eligible_cursor = 0
+    eligible = st.session_state.eligible_job_ids
+    cursor = st.session_state.eligible_cursor
+    while cursor < len(eligible) and eligible[cursor] in applied_jobs:
+        cursor += 1
+    st.session_state.eligible_cursor = cursor
+    upcoming_ids = list(itertools.islice((i for i in itertools.islice(eligible, cursor, None) if i not in applied_jobs), PREGENERATE_COUNT))
+
+    if not upcoming_ids:
         st.info("🎉 All jobs from the CSV have been processed!")
         return
 
-    job_id, row_data = next_job
+    job_id = upcoming_ids[0]
     
     if st.session_state.current_job_id != job_id:
+        if jobs_df is None:
+            jobs_df = load_jobs_df(CSV_FILE, st.session_state.eligible_csv_mtime)
         st.session_state.current_job_id = job_id
-        st.session_state.generated_email_content = None
-        st.session_state.current_job_details = {
-            "job_id": job_id, "job_title": row_data.get("job_title", "N/A"),
-            "hospital_name": row_data.get("hospital_name", ""), "canton": row_data.get("canton", ""),
-            "contact_email": str(row_data.get("Application Contact Email", "")).strip().split(",")[0],
-            "application_url": row_data.get("Application URL", ""),
-            "job_description": row_data.get("Job Description (short)", "")
-        }
+        st.session_state.generated_email_content = st.session_state.draft_cache.get(draft_cache_key(job_id))
+        st.session_state.current_job_details = job_details_from_row(job_id, jobs_df.loc[job_id])
 
     details = st.session_state.current_job_details
     st.subheader(f"Next Up: {details['job_title']}")
@@ -267,25 +786,82 @@ def render_job_finder(db):
     
     col1, col2 = st.columns([3, 1])
     with col1:
+        cache_key = draft_cache_key(details['job_id'])
         if st.button(f"🤖 Prepare Application for Job #{details['job_id']}"):
-             with st.spinner("Generating personalized email with OpenAI..."):
-                email_content = generate_personalized_email(
-                    details['job_title'], details['hospital_name'], details['canton'],
-                    details['job_description'], st.session_state.cv_content
-                )
-                st.session_state.generated_email_content = email_content
+            if cache_key in st.session_state.draft_cache:
+                st.session_state.generated_email_content = st.session_state.draft_cache[cache_key]
+            else:
+                st.session_state.generated_email_content = stream_personalized_email(details)
+                if st.session_state.generated_email_content:
+                    st.session_state.draft_cache[cache_key] = st.session_state.generated_email_content
     with col2:
         if st.button("Skip Job ⏭️"):
-            update_user_data(db, {"applied_jobs": firestore.ArrayUnion([str(details['job_id'])])})
-            db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).update({f'stats.skipped_count': firestore.Increment(1)})
+            mark_job_applied(db, details['job_id'], "skipped_count")
+            st.session_state.applied_job_ids.add(details['job_id'])
             st.warning(f"Skipped job #{details['job_id']}. Moving to next.")
             st.session_state.current_job_id = None
             st.rerun()
 
-    if st.session_state.get('generated_email_content'):
+    pending_ids = [i for i in upcoming_ids if draft_cache_key(i) not in st.session_state.draft_cache]
+    if pending_ids and st.button(f"⚡ Pre-generate next {len(pending_ids)} drafts"):
+        with st.spinner("Generating drafts with OpenAI..."):
+            if jobs_df is None:
+                jobs_df = load_jobs_df(CSV_FILE, st.session_state.eligible_csv_mtime)
+            pending_jobs = [job_details_from_row(i, jobs_df.loc[i]) for i in pending_ids]
+            drafts = generate_personalized_emails_batch(pending_jobs, st.session_state.cv_content)
+            # Jobs the batched answer skipped or mangled are retried as concurrent single requests
+            missing = [n for n, draft in enumerate(drafts) if not draft]
+            if missing:
+                retried = generate_personalized_emails([pending_jobs[n] for n in missing], st.session_state.cv_content)
+                for n, draft in zip(missing, retried):
+                    drafts[n] = draft
+        for i, draft in zip(pending_ids, drafts):
+            if draft:
+                st.session_state.draft_cache[draft_cache_key(i)] = draft
+        if not st.session_state.generated_email_content:
+            st.session_state.generated_email_content = st.session_state.draft_cache.get(cache_key)
+
+    if st.session_state.generated_email_content:
         render_application_form(db)
 
+def stream_personalized_email(details):
+    """Generates the email for a CSV job, showing the text while it streams in."""
+    prompt = build_email_prompt(
+        details['job_title'], details['hospital_name'], details['canton'],
+        details['job_description'], st.session_state.cv_content
+    )
+    chunks = call_openai_api(prompt, EMAIL_SYSTEM_MESSAGE, stream=True)
+    if chunks is None:
+        return None
+    preview = st.empty()
+    try:
+        with preview.container():
+            response = st.write_stream(chunks)
+    except Exception as e:
+        # The stream can also fail after create() returned, e.g. on a dropped connection
+        st.error(f"Error calling OpenAI API: {e}")
+        return None
+    finally:
+        preview.empty()
+    if not response or not response.strip():
+        return None  # An empty answer is a failure, so it must not end up in the draft cache
+    return parse_email_response(response.strip(), details['job_title'])
+
+def attachment_key(attachment):
+    # Stable across removals, unlike the list position
+    return attachment.get("gcs_path", attachment["name"])
+
+def remove_attachment(attachment_id):
+    # Looked up by identifier, so a stale second click cannot remove a different file
+    attachments = st.session_state.attachments
+    for i, attachment in enumerate(attachments):
+        if attachment_key(attachment) == attachment_id:
+            del attachments[i]
+            break
+
+@st.fragment
 def render_application_form(db, is_manual=False):
+    # A fragment: polishing and attachment edits rerun only this form; a send reruns the whole app
     st.markdown("---")
     st.subheader("✉️ Review, Edit, and Send Application")
 
@@ -308,92 +884,184 @@ def render_application_form(db, is_manual=False):
         
         new_attachments = st.file_uploader("Add more files", accept_multiple_files=True, key=f"uploader_{form_key}")
         
+        # Polishing submits the form too, so it works on the body as currently edited
+        polish_button = st.form_submit_button(f"✨ Polish with {POLISH_MODEL}")
         send_button = st.form_submit_button("🚀 Send Application")
 
+    if polish_button:
+        with st.spinner(f"Polishing email with {POLISH_MODEL}..."):
+            polished = polish_email_body(body)
+        if polished:
+            email_content['subject'] = subject
+            email_content['body'] = polished
+            st.rerun(scope="fragment")
+
     if st.session_state.attachments:
         st.write("Current Attachments:")
-        # Loop backwards to avoid index errors when removing items
-        for i in range(len(st.session_state.attachments) - 1, -1, -1):
-            attached_file = st.session_state.attachments[i]
+        # The callback removes the file before the fragment reruns, so no explicit st.rerun() is needed
+        for i, attached_file in enumerate(st.session_state.attachments):
             c1, c2 = st.columns([0.8, 0.2])
-            c1.info(f"📄 {attached_file.name}")
-            if c2.button(f"Remove", key=f"remove_{i}_{form_key}_{attached_file.name}"):
-                st.session_state.attachments.pop(i)
-                st.rerun()
+            c1.info(f"📄 {attached_file['name']}")
+            attachment_id = attachment_key(attached_file)
+            c2.button("Remove", key=f"remove_{form_key}_{i}_{attachment_id}", on_click=remove_attachment, args=(attachment_id,))
 
     if send_button:
-        current_attachments = st.session_state.attachments + (new_attachments or [])
+        current_attachments = st.session_state.attachments + [attachment_from_upload(f) for f in new_attachments or []]
         if not current_attachments:
             st.warning("You must have at least one attachment (your CV)."); return
 
-        if send_email_logic(st.session_state.gmail_service, contact_email, subject, body, current_attachments):
+        future = send_email_logic(st.session_state.gmail_service, contact_email, subject, body, current_attachments)
+        if future:
             email_record = {
                 "recipient": contact_email, "subject": subject, "body": body,
                 "sent_at": firestore.SERVER_TIMESTAMP, "job_title": details['job_title'],
-                "hospital_name": details.get('hospital_name', 'Manual Entry')
+                "hospital_name": details.get('hospital_name', 'Manual Entry'), "status": "pending"
             }
-            save_sent_email(db, email_record)
-            
+
             if not is_manual:
-                update_user_data(db, {"applied_jobs": firestore.ArrayUnion([str(details['job_id'])])})
-                db.collection(DB_COLLECTION).document(DB_DOCUMENT_ID).update({f'stats.sent_count': firestore.Increment(1)})
+                email_ref = mark_job_applied(db, details['job_id'], "sent_count", sent_email=email_record)
+                st.session_state.applied_job_ids.add(details['job_id'])
                 st.session_state.current_job_id = None
             else:
+                email_ref = save_sent_email(db, email_record)
                 st.session_state.manual_email_content = None
-            
-            st.balloons()
+
+            job_id = None if is_manual else details['job_id']
+            st.session_state.pending_sends.append({
+                "recorded": record_send_outcome(db, future, email_ref, job_id),
+                "recipient": contact_email, "job_id": job_id,
+            })
             st.rerun()
 
+def poll_pending_sends():
+    """Reports background sends; the polling fragment is only rendered while sends are in flight."""
+    # Status write failures stay visible for the session: Firestore no longer matches what was sent
+    for message in st.session_state.send_record_errors:
+        st.warning(message)
+    if st.session_state.pending_sends:
+        _poll_pending_sends()
+
+@st.fragment(run_every=SEND_POLL_INTERVAL)
+def _poll_pending_sends():
+    if not st.session_state.pending_sends:
+        # The last send was reported on the previous pass; a full rerun drops this fragment and its timer
+        st.rerun()
+    still_pending = []
+    for send in st.session_state.pending_sends:
+        if not send["recorded"].done():
+            still_pending.append(send)
+            continue
+        error, record_error = send["recorded"].result()
+        if error is None:
+            st.toast(f"✅ Application successfully sent to {send['recipient']}!")
+            st.balloons()
+        else:
+            if send["job_id"] is not None and record_error is None:
+                bump_local_stat("sent_count", -1)
+                st.session_state.applied_job_ids.discard(send["job_id"])
+                st.session_state.eligible_job_ids = None
+            st.toast(f"❌ An error occurred while sending the email to {send['recipient']}: {error}")
+        if record_error is not None:
+            message = f"The status of the email to {send['recipient']} could not be saved: {record_error}"
+            st.session_state.send_record_errors.append(message)
+            st.warning(message)
+        _get_user_data_cached.clear()
+        fetch_sent_emails_page.clear()
+    st.session_state.pending_sends = still_pending
+    if still_pending:
+        st.info(f"📤 Sending {len(still_pending)} application(s) in the background...")
+
 # ================================
 # MAIN APP LAYOUT & LOGIC
 # ================================
 st.set_page_config(layout="wide")
 st.title("🇨🇭 Swiss Assistenzarzt Job Application Bot")
 
-if 'step' not in st.session_state:
-    st.session_state.step = "auth"
-    st.session_state.gmail_service = None
-    st.session_state.cv_content = None
-    st.session_state.attachments = []
-    st.session_state.current_job_id = None
-    st.session_state.generated_email_content = None
-    st.session_state.manual_email_content = None
+# Mutable defaults are factories so every session gets its own object
+SESSION_DEFAULTS = {
+    "step": "auth",
+    "gmail_service": None,
+    "gmail_auth_url": None,
+    "cv_content": None,
+    "attachments": list,
+    "current_job_id": None,
+    "generated_email_content": None,
+    "manual_email_content": None,
+    "applied_job_ids": None,
+    "eligible_job_ids": None,
+    "eligible_csv_mtime": None,
+    "eligible_cursor": 0,
+    "user_data": None,
+    "dashboard_pages": 1,
+    "dashboard_bodies": dict,
+    "draft_cache": dict,
+    "send_executor": lambda: ThreadPoolExecutor(max_workers=1),
+    "pending_sends": list,
+    "send_record_errors": list,
+}
+for key, default in SESSION_DEFAULTS.items():
+    if key not in st.session_state:
+        st.session_state[key] = default() if callable(default) else default
 
 db = get_firestore_db()
 if not db: st.stop()
 
 if st.session_state.step == "auth":
     st.header("Step 1: Authorize Your Gmail Account")
-    if st.button("Authorize Gmail"):
+    auth_code = st.query_params.get("code")
+    if auth_code or st.button("Authorize Gmail"):
         with st.spinner("Authenticating..."):
-            st.session_state.gmail_service = gmail_authenticate()
+            try:
+                st.session_state.gmail_service = gmail_authenticate(auth_code, st.query_params.get("state"))
+            finally:
+                # A code can only be exchanged once; a stale one must not fail every later rerun
+                st.query_params.clear()
         if st.session_state.gmail_service:
             st.session_state.step = "upload_cv"
             st.rerun()
+        if st.session_state.gmail_auth_url is None:
+            st.session_state.gmail_auth_url = get_gmail_auth_url()
+        if st.session_state.gmail_auth_url:
+            st.link_button("Sign in with Google", st.session_state.gmail_auth_url)
 
 elif st.session_state.step == "upload_cv":
     st.header("Step 2: Upload Your Documents")
-    user_data = get_user_data(db)
+    user_data = load_user_data(db)
     if user_data.get("translated_cv") and st.button("Use previously saved CV"):
         st.session_state.cv_content = user_data["translated_cv"]
+        # A copy, so removing an attachment in the form does not edit the cached user document
+        st.session_state.attachments = list(user_data.get("attachments", []))
         st.success("Loaded CV from database.")
         st.session_state.step = "main_app"
         st.rerun()
 
     uploaded_files = st.file_uploader("Upload your CV (must be the first file) and other attachments.", accept_multiple_files=True)
-    if uploaded_files:
-        st.session_state.attachments = uploaded_files
+    if uploaded_files and sum(f.size for f in uploaded_files) > MAX_ATTACHMENTS_BYTES:
+        st.error(f"Attachments exceed Gmail's {MAX_ATTACHMENTS_BYTES // (1024 * 1024)} MB limit. Please remove or compress some files.")
+    elif uploaded_files:
         cv_file = uploaded_files[0]
-        with st.spinner("Reading CV..."): cv_text = extract_text_from_pdf(cv_file)
+        cv_bytes = cv_file.getvalue()
+        with st.spinner("Reading CV..."): cv_text = extract_text_from_pdf(cv_bytes)
         
         if cv_text:
-            lang = st.radio("Is the CV in English (needs translation) or German?", ("English", "German"))
+            lang = st.radio(
+                "Is the CV in English (needs translation) or German?", ("English", "German"),
+                index=1 if cv_looks_german(cv_text) else 0,
+            )
             if st.button("Confirm and Proceed"):
+                with st.spinner("Saving attachments..."):
+                    st.session_state.attachments = save_attachments(db, uploaded_files)
                 if "English" in lang:
                     with st.spinner("Translating CV..."):
-                        translated = translate_cv_text(cv_text)
+                        # Identical CV files reuse the earlier translation instead of calling OpenAI again
+                        cv_hash = hashlib.sha256(cv_bytes).hexdigest()
+                        translated = get_cached_translation(db, cv_hash)
+                        if not translated:
+                            translated = translate_cv_text(cv_text)
+                            if translated:
+                                save_cached_translation(db, cv_hash, translated)
                         st.session_state.cv_content = translated
-                        update_user_data(db, {"translated_cv": translated})
+                        apply_user_update(db, {"translated_cv": translated})
                 else:
                     st.session_state.cv_content = cv_text
                 
@@ -402,11 +1070,12 @@ elif st.session_state.step == "upload_cv":
                 st.rerun()
             
 elif st.session_state.step == "main_app":
+    user_data = load_user_data(db)
     if not st.session_state.cv_content:
         # Attempt to load from DB one more time if not in state
-        user_data = get_user_data(db)
         if user_data.get("translated_cv"):
              st.session_state.cv_content = user_data["translated_cv"]
+             st.session_state.attachments = st.session_state.attachments or list(user_data.get("attachments", []))
         else:
             st.warning("CV has not been processed. Please return to the upload step.")
             if st.button("Go to Upload Step"):
@@ -414,7 +1083,7 @@ elif st.session_state.step == "main_app":
                 st.rerun()
             st.stop()
 
-    user_data = get_user_data(db)
+    poll_pending_sends()
     with st.sidebar:
         st.header("Navigation")
         app_page = st.radio("Go to", ["Job Finder", "Add Manual Job", "Dashboard"])
@@ -425,7 +1094,7 @@ elif st.session_state.step == "main_app":
         st.metric("Emails Sent", stats.get("sent_count", 0))
         st.metric("Jobs Skipped", stats.get("skipped_count", 0))
 
-    if app_page == "Job Finder": render_job_finder(db)
+    if app_page == "Job Finder": render_job_finder(db, user_data)
     elif app_page == "Dashboard": render_dashboard(db)
     elif app_page == "Add Manual Job": render_manual_job_page(db)
 